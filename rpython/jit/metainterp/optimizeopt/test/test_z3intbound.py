@@ -3,11 +3,15 @@ IntBound methods with Z3.
 
 The approach is to generate random bounds, then perform operations on them, and
 ask Z3 whether the resulting bound is a sound approximation of the result.
+
+The tests are independent of each other, so the file can be distributed over
+several cores with pytest-xdist (-n auto).
 """
 
 import pytest
 import sys
 import gc
+import hashlib
 
 from rpython.rlib.rarithmetic import LONG_BIT, r_uint, intmask, ovfcheck
 from rpython.jit.metainterp.optimizeopt.intutils import (
@@ -28,15 +32,31 @@ from rpython.jit.metainterp.optimizeopt.test.test_z3checktests import z3_pymod,
 
 try:
     import z3
-    from hypothesis import given, strategies, assume, example
+    from hypothesis import given, strategies, assume, example, settings
 except ImportError:
     pytest.skip("please install z3 (z3-solver on pypi) and hypothesis")
 
+# the z3 constants and variables are interned. LONG_BIT is part of the key
+# because of z3_with_reduced_bitwidth. the caches are cleared by
+# teardown_function
+_bitvecval_cache = {}
+_bitvec_cache = {}
+
 def BitVecVal(value):
-    return z3.BitVecVal(value, LONG_BIT)
+    key = value, LONG_BIT
+    try:
+        return _bitvecval_cache[key]
+    except KeyError:
+        res = _bitvecval_cache[key] = z3.BitVecVal(value, LONG_BIT)
+        return res
 
 def BitVec(name):
-    return z3.BitVec(name, LONG_BIT)
+    key = name, LONG_BIT
+    try:
+        return _bitvec_cache[key]
+    except KeyError:
+        res = _bitvec_cache[key] = z3.BitVec(name, LONG_BIT)
+        return res
 
 def z3_with_reduced_bitwidth(width):
     def dec(test):
@@ -55,23 +75,32 @@ def z3_with_reduced_bitwidth(width):
 MAXINT = sys.maxint
 MININT = -sys.maxint - 1
 
-uints = strategies.builds(
-    r_uint,
-    strategies.integers(min_value=0, max_value=2**LONG_BIT - 1)
-)
+# .map() instead of strategies.builds(): the strategies are drawn very often,
+# and map has less per-draw overhead
+uints = strategies.integers(min_value=0, max_value=2**LONG_BIT - 1).map(
+    r_uint)
 
-ints = strategies.builds(
-    lambda x: intmask(r_uint(x)),
-    strategies.integers(min_value=0, max_value=2**LONG_BIT - 1)
-)
+ints = strategies.integers(min_value=0, max_value=2**LONG_BIT - 1).map(
+    lambda x: intmask(r_uint(x)))
 
-bounds = strategies.builds(
-    lambda tup: tup[0],
-    knownbits_and_bound_with_contained_number
-)
+bounds = knownbits_and_bound_with_contained_number.map(lambda tup: tup[0])
+
+def bound_pairs_where(methname):
+    """ pairs of bounds (b1, b2) where b1.methname(b2) is true. filtering
+    in the strategy avoids rejecting whole examples with assume """
+    return strategies.tuples(bounds, bounds).filter(
+        lambda pair: getattr(pair[0], methname)(pair[1]))
 
 varname_counter = 0
 
+def reset_varnames():
+    # the variable names only need to be unique within a single example. by
+    # starting from bv0 for every example the same example always produces
+    # the same z3 terms, which makes _result_cache hit when hypothesis
+    # replays it. the tests with expensive queries call this first
+    global varname_counter
+    varname_counter = 0
+
 def z3_tnum_condition(variable, tvalue, tmask):
     if isinstance(tvalue, r_uint):
         tvalue = BitVecVal(tvalue)
@@ -82,11 +111,23 @@ def z3_tnum_condition(variable, tvalue, tmask):
 def z3_tvalue_tmask_are_valid(tvalue, tmask):
     return tvalue & ~tmask == tvalue
 
+def z3_element_conditions(variable, lower, upper, tvalue, tmask):
+    """ return the list of conditions for variable being an element of the
+    set described by lower, upper, tvalue and tmask. the well-formedness of
+    tvalue and tmask is not part of it. """
+    return [
+        z3_tnum_condition(variable, tvalue, tmask),
+        lower <= variable,
+        variable <= upper,
+    ]
+
 def to_z3(bound, variable=None):
     global varname_counter
     if variable is None:
         variable = BitVec("bv%s" % (varname_counter, ))
         varname_counter += 1
+    if bound.is_unbounded():
+        return variable, z3.BoolVal(True)
     components = []
     if bound.upper < MAXINT:
         components.append(variable <= BitVecVal(bound.upper))
@@ -98,27 +139,99 @@ def to_z3(bound, variable=None):
         return variable, components[0]
     if len(components) == 0:
         return variable, z3.BoolVal(True)
-    return variable, z3.And(*components)
+    return variable, z3.And(components)
 
 class CheckError(Exception):
     pass
 
 
-def prove_implies(*args, **kwargs):
+def implies(*args):
     last = args[-1]
-    prev = args[:-1]
-    return prove(z3.Implies(z3.And(*prev), last), **kwargs)
+    if z3.is_true(last):
+        return last
+    # the formulas of unbounded bounds are just True, leave them out
+    prev = [arg for arg in args[:-1] if not z3.is_true(arg)]
+    if not prev:
+        return last
+    return z3.Implies(z3.And(prev), last)
+
+def prove_implies(*args, **kwargs):
+    return prove(implies(*args), **kwargs)
+
+_teardown_counter = 0
 
 def teardown_function(function):
-    # z3 doesn't add enough memory pressure, just collect after every function
-    # to counteract
-    gc.collect()
+    # z3 doesn't add enough memory pressure, collect every few functions to
+    # counteract. the shared solver is reset to free what z3 keeps for it
+    global _teardown_counter, _solver_timeout
+    _bitvecval_cache.clear()
+    _bitvec_cache.clear()
+    _result_cache.clear()
+    reset_varnames()
+    if _solver is not None:
+        _solver.reset()
+        _solver_timeout = None # set it again on the next use
+    _teardown_counter += 1
+    if _teardown_counter % 16 == 0:
+        gc.collect()
+
+# a single solver is shared by all the proofs, every query is done in its own
+# push/pop scope
+_solver = None
+_solver_timeout = None
+Z3_NO_TIMEOUT = 2 ** 32 - 1 # z3's default
+
+# all the queries are quantifier-free bitvector problems, so bit-blast them
+# straight away instead of letting z3 pick a strategy for every query
+QF_BV_TACTIC = ("simplify", "propagate-values", "solve-eqs", "bit-blast",
+                "sat")
+
+def make_solver():
+    return z3.Then(*QF_BV_TACTIC).solver()
+
+def get_solver(timeout=Z3_NO_TIMEOUT):
+    global _solver, _solver_timeout
+    if _solver is None:
+        _solver = make_solver()
+    if timeout != _solver_timeout:
+        _solver.set("timeout", timeout)
+        _solver_timeout = timeout
+    return _solver
+
+def check_sat(cond, timeout=Z3_NO_TIMEOUT):
+    """ check cond with the shared solver. returns the z3 result and the
+    model if the result is sat. """
+    solver = get_solver(timeout)
+    solver.push()
+    try:
+        solver.add(cond)
+        z3res = solver.check()
+        if z3res == z3.sat:
+            return z3res, solver.model()
+        return z3res, None
+    finally:
+        solver.pop()
+
+def get_timeout(use_timeout):
+    if use_timeout and pytest.config.option.z3timeout:
+        return pytest.config.option.z3timeout
+    return Z3_NO_TIMEOUT
+
+# results of prove, to not redo the same queries while hypothesis is
+# shrinking. {sha1 of the condition: (z3 result, model)}, timeouts are not
+# cached. cleared by teardown_function
+_result_cache = {}
 
 def prove(cond, use_timeout=True):
-    solver = z3.Solver()
-    if use_timeout and pytest.config.option.z3timeout:
-        solver.set("timeout", pytest.config.option.z3timeout)
-    z3res = solver.check(z3.Not(cond))
+    if z3.is_true(cond):
+        return
+    key = hashlib.sha1(cond.sexpr()).digest()
+    try:
+        z3res, z3model = _result_cache[key]
+    except KeyError:
+        z3res, z3model = check_sat(z3.Not(cond), get_timeout(use_timeout))
+        if z3res != z3.unknown:
+            _result_cache[key] = z3res, z3model
     if z3res == z3.unsat:
         pass
     elif z3res == z3.unknown:
@@ -127,25 +240,63 @@ def prove(cond, use_timeout=True):
     elif z3res == z3.sat:
         # not possible to prove!
         global model
-        model = solver.model()
+        model = z3model
         raise CheckError(cond, model)
 
-@given(bounds, bounds)
+def batched_given(*strats, **kwargs):
+    """ like given, but the test is called on batch examples at a time, and
+    must return the z3 condition to prove instead of proving it. the
+    conditions of all the examples of a batch are proven with a single z3
+    query. the total number of examples is at least the same as with given.
+    the only keyword argument is batch, the number of examples per batch.
+    """
+    # hypothesis caps the size of its first examples, larger batches of bounds
+    # regularly overrun that cap and fail the data_too_large health check
+    batch = kwargs.pop('batch', 3)
+    if kwargs:
+        raise TypeError("unexpected keyword arguments: %s" %
+                        ", ".join(sorted(kwargs)))
+    def dec(test):
+        def newtest(examples):
+            conds = []
+            for example in examples:
+                # each condition is valid on its own iff the conjunction is,
+                # so the examples of a batch can reuse the same names
+                reset_varnames()
+                conds.append(test(*example))
+            timeout = get_timeout(True)
+            if timeout != Z3_NO_TIMEOUT:
+                timeout *= len(conds)
+            z3res, _ = check_sat(z3.Not(z3.And(conds)), timeout)
+            if z3res != z3.unsat:
+                # a counterexample or a timeout: prove the conditions one by
+                # one, to find the failing example
+                for cond in conds:
+                    prove(cond)
+        newtest.func_name = test.func_name
+        newtest = given(strategies.lists(strategies.tuples(*strats),
+                                         min_size=batch, max_size=batch)
+                       )(newtest)
+        max_examples = settings.default.max_examples
+        return settings(
+            max_examples=(max_examples + batch - 1) // batch,
+        )(newtest)
+    return dec
+
+@batched_given(bounds, bounds)
 def test_add(b1, b2):
     b3 = b1.add_bound(b2)
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
     var3, formula3 = to_z3(b3, var1 + var2)
-    prove_implies(formula1, formula2, formula3)
+    return implies(formula1, formula2, formula3)
 
-@given(bounds, bounds)
-def test_add_bound_cannot_overflow(b1, b2):
-    bound = b1.add_bound_cannot_overflow(b2)
-    assume(bound)
+@given(bound_pairs_where('add_bound_cannot_overflow'))
+def test_add_bound_cannot_overflow(pair):
+    b1, b2 = pair
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
-    m = z3.SignExt(LONG_BIT, var1) + z3.SignExt(LONG_BIT, var2)
-    no_ovf = m == z3.SignExt(LONG_BIT, var1 + var2)
+    _, no_ovf = z3_add_overflow(var1, var2)
     prove_implies(formula1, formula2, no_ovf)
 
 @given(bounds, bounds)
@@ -154,26 +305,23 @@ def test_add_bound_no_overflow(b1, b2):
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
     var3, formula3 = to_z3(b3, var1 + var2)
-    m = z3.SignExt(LONG_BIT, var1) + z3.SignExt(LONG_BIT, var2)
-    no_ovf = m == z3.SignExt(LONG_BIT, var1 + var2)
+    _, no_ovf = z3_add_overflow(var1, var2)
     prove_implies(formula1, formula2, no_ovf, formula3)
 
-@given(bounds, bounds)
+@batched_given(bounds, bounds)
 def test_sub(b1, b2):
     b3 = b1.sub_bound(b2)
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
     var3, formula3 = to_z3(b3, var1 - var2)
-    prove_implies(formula1, formula2, formula3)
+    return implies(formula1, formula2, formula3)
 
-@given(bounds, bounds)
-def test_sub_bound_cannot_overflow(b1, b2):
-    bound = b1.sub_bound_cannot_overflow(b2)
-    assume(bound)
+@given(bound_pairs_where('sub_bound_cannot_overflow'))
+def test_sub_bound_cannot_overflow(pair):
+    b1, b2 = pair
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
-    m = z3.SignExt(LONG_BIT, var1) - z3.SignExt(LONG_BIT, var2)
-    no_ovf = m == z3.SignExt(LONG_BIT, var1 - var2)
+    _, no_ovf = z3_sub_overflow(var1, var2)
     prove_implies(formula1, formula2, no_ovf)
 
 @given(bounds, bounds)
@@ -182,12 +330,13 @@ def test_sub_bound_no_overflow(b1, b2):
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
     var3, formula3 = to_z3(b3, var1 - var2)
-    m = z3.SignExt(LONG_BIT, var1) - z3.SignExt(LONG_BIT, var2)
-    no_ovf = m == z3.SignExt(LONG_BIT, var1 - var2)
+    _, no_ovf = z3_sub_overflow(var1, var2)
     prove_implies(formula1, formula2, no_ovf, formula3)
 
 @given(bounds, bounds)
 def test_mul(b1, b2):
+    # not batched: multiplications make the combined query much harder
+    reset_varnames()
     b3 = b1.mul_bound(b2)
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
@@ -196,6 +345,7 @@ def test_mul(b1, b2):
 
 @given(bounds, bounds)
 def test_mul_bound_cannot_overflow(b1, b2):
+    reset_varnames()
     bound = b1.mul_bound_cannot_overflow(b2)
     if bound:
         var1, formula1 = to_z3(b1)
@@ -206,6 +356,7 @@ def test_mul_bound_cannot_overflow(b1, b2):
 
 @given(bounds, bounds)
 def test_mul_bound_no_overflow(b1, b2):
+    reset_varnames()
     b3 = b1.mul_bound_no_overflow(b2)
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
@@ -214,12 +365,12 @@ def test_mul_bound_no_overflow(b1, b2):
     no_ovf = m == z3.SignExt(LONG_BIT, var1 * var2)
     prove_implies(formula1, formula2, no_ovf, formula3)
 
-@given(bounds)
+@batched_given(bounds)
 def test_neg(b1):
     b2 = b1.neg_bound()
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2, -var1)
-    prove_implies(formula1, formula2)
+    return implies(formula1, formula2)
 
 @given(bounds, bounds)
 def test_known(b1, b2):
@@ -238,6 +389,7 @@ def test_known(b1, b2):
 
 @given(bounds, bounds)
 def test_mod(b1, b2):
+    reset_varnames()
     b3 = b1.mod_bound(b2)
     print b1, b2, b3
     var1, formula1 = to_z3(b1)
@@ -250,36 +402,36 @@ def test_mod(b1, b2):
 # ____________________________________________________________
 # boolean operations
 
-@given(bounds, bounds)
+@batched_given(bounds, bounds)
 def test_and(b1, b2):
     b3 = b1.and_bound(b2)
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
     var3, formula3 = to_z3(b3, var1 & var2)
-    prove_implies(formula1, formula2, formula3)
+    return implies(formula1, formula2, formula3)
 
-@given(bounds, bounds)
+@batched_given(bounds, bounds)
 def test_or(b1, b2):
     b3 = b1.or_bound(b2)
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
     var3, formula3 = to_z3(b3, var1 | var2)
-    prove_implies(formula1, formula2, formula3)
+    return implies(formula1, formula2, formula3)
 
-@given(bounds, bounds)
+@batched_given(bounds, bounds)
 def test_xor(b1, b2):
     b3 = b1.xor_bound(b2)
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2)
     var3, formula3 = to_z3(b3, var1 ^ var2)
-    prove_implies(formula1, formula2, formula3)
+    return implies(formula1, formula2, formula3)
 
-@given(bounds)
+@batched_given(bounds)
 def test_invert(b1):
     b2 = b1.invert_bound()
     var1, formula1 = to_z3(b1)
     var2, formula2 = to_z3(b2, ~var1)
-    prove_implies(formula1, formula2)
+    return implies(formula1, formula2)
 
 
 # ____________________________________________________________
@@ -308,8 +460,8 @@ def test_shrink_mixed(x, y, value, tmask):
     b = IntBound(x, y, value & ~tmask, tmask, do_shrinking=False)
     var1, formula1 = to_z3(b)
     # check that b contains values before we shrink
-    solver = z3.Solver()
-    assume(solver.check(formula1) == z3.sat)
+    z3res, _ = check_sat(formula1)
+    assume(z3res == z3.sat)
     b.shrink()
     var1, formula2 = to_z3(b, var1)
     prove_implies(formula1, formula2)
@@ -338,16 +490,13 @@ def test_prove_lowest_set_bit_only():
         x == 0,
         res == 0,
     )
-    # do it the pedestrian way: if a bit is set, then the bits with lower
-    # indexes must be 0
-    conditions = []
-    for i in range(LONG_BIT):
-        for j in range(i):
-            cond = z3.Implies(z3.Extract(i, i, res) == 1, z3.Extract(j, j, res) == 0)
-            conditions.append(cond)
-
-    prove(
-        z3.And(*conditions)
+    # if a bit is set, then the bits with lower indexes must be 0, ie at most
+    # one bit is set
+    prove(res & (res - 1) == 0)
+    # the bit is set in x, and no lower bit of x is set
+    prove_implies(
+        x != 0,
+        z3.And(res & x == res, x & (res - 1) == 0),
     )
 
 # ____________________________________________________________
@@ -370,10 +519,7 @@ def make_z3_bound_and_tnum(name):
     upper = BitVec(name + "_upper")
     lower = BitVec(name + "_lower")
     formula = z3.And(
-        z3_tnum_condition(variable, tvalue, tmask),
-        lower <= variable,
-        variable <= upper
-    )
+        z3_element_conditions(variable, lower, upper, tvalue, tmask))
     return variable, lower, upper, tvalue, tmask, formula
 
 def popcount64(w):
@@ -388,15 +534,15 @@ def test_popcount64():
     assert popcount64((1 << 63) + 0b11010110111) == 9
 
 def z3_add_overflow(a, b):
+    # the z3 overflow predicates are cheaper than comparing against the
+    # result computed with twice the bit width
     result = a + b
-    result_wide = z3.SignExt(LONG_BIT, a) + z3.SignExt(LONG_BIT, b)
-    no_ovf = result_wide == z3.SignExt(LONG_BIT, result)
+    no_ovf = z3.And(z3.BVAddNoOverflow(a, b, True), z3.BVAddNoUnderflow(a, b))
     return result, no_ovf
 
 def z3_sub_overflow(a, b):
     result = a - b
-    result_wide = z3.SignExt(LONG_BIT, a) - z3.SignExt(LONG_BIT, b)
-    no_ovf = result_wide == z3.SignExt(LONG_BIT, result)
+    no_ovf = z3.And(z3.BVSubNoOverflow(a, b), z3.BVSubNoUnderflow(a, b, True))
     return result, no_ovf
 
 def z3_mul_overflow(a, b):
@@ -416,7 +562,16 @@ def s(p):
 def u(p):
     print "r_uint(%s)" % bin(model.evaluate(p).as_long())
 
+def _ast_key(x):
+    if isinstance(x, z3.AstRef):
+        return x.get_id()
+    return x
+
 class Z3IntBound(IntBound):
+    # created on the first call of z3_formula, most intermediate instances
+    # never need it
+    _z3_formula_cache = None
+
     def __init__(self, lower, upper, tvalue, tmask, concrete_variable=None):
         self.lower = lower
         self.upper = upper
@@ -478,15 +633,32 @@ class Z3IntBound(IntBound):
         if variable is None:
             variable = self.concrete_variable
             assert variable is not None
-        result = z3.And(
-            # is the tnum well-formed? ie are the unknown bits in tvalue set to 0?
-            self.tvalue & ~self.tmask == self.tvalue,
-            # does variable fulfill the conditions imposed by tvalue and tmask?
-            z3_tnum_condition(variable, self.tvalue, self.tmask),
-            # does variable fulfill the conditions of the bounds?
-            self.lower <= variable,
-            variable <= self.upper,
-        )
+        # the fields can be reassigned by the tests, so they are part of the
+        # key. the cache entry keeps the asts alive, so their ids stay unique
+        asts = (variable, self.lower, self.upper, self.tvalue, self.tmask)
+        key = (must_be_minimal, ) + tuple([_ast_key(x) for x in asts])
+        if self._z3_formula_cache is None:
+            self._z3_formula_cache = {}
+        try:
+            return self._z3_formula_cache[key][0]
+        except KeyError:
+            pass
+        result = self._z3_formula(variable, must_be_minimal)
+        self._z3_formula_cache[key] = result, asts
+        return result
+
+    def _z3_formula(self, variable, must_be_minimal):
+        # does variable fulfill the conditions imposed by the bounds and by
+        # tvalue and tmask?
+        components = z3_element_conditions(
+            variable, self.lower, self.upper, self.tvalue, self.tmask)
+        if z3.is_bv_value(self.tmask) and self.tmask.as_long() == 2 ** LONG_BIT - 1:
+            # all bits are unknown, the tnum condition is just tvalue == 0
+            # again, which is implied by the well-formedness
+            del components[0]
+        # is the tnum well-formed? ie are the unknown bits in tvalue set to 0?
+        components.append(z3_tvalue_tmask_are_valid(self.tvalue, self.tmask))
+        result = z3.And(components)
         if must_be_minimal:
             tvalue, tmask, valid = self._tnum_improve_knownbits_by_bounds()
             result = z3.And(
@@ -542,12 +714,12 @@ def test_prove_invert():
 def test_prove_min_max_unsigned_by_knownbits():
     bound = make_z3_intbounds_instance('self')
     minimum = bound.get_minimum_unsigned_by_knownbits()
-    bound.prove_implies(
-        z3.ULE(minimum, bound.concrete_variable),
-    )
     maximum = bound.get_maximum_unsigned_by_knownbits()
     bound.prove_implies(
-        z3.ULE(bound.concrete_variable, maximum),
+        z3.And(
+            z3.ULE(minimum, bound.concrete_variable),
+            z3.ULE(bound.concrete_variable, maximum),
+        )
     )
 
 def test_prove_min_max_signed_by_knownbits():
@@ -984,28 +1156,20 @@ def test_prove_shrink_bounds_by_knownbits_min_case1():
     working_min, cl2set, set2cl = b1._helper_min_max_prepare(threshold)
     new_threshold = b1._helper_min_case1(working_min, cl2set)
 
-    # show that the new_threshold is larger than threshold
-    b1.prove_implies(
-        b1._get_minimum_signed_by_knownbits() < threshold,
-        working_min != threshold,
-        z3.UGT(cl2set, set2cl),
-        new_threshold > threshold,
-    )
-    # correctness: show that there are no elements x in b1 with
-    # threshold <= x < new_threshold
     b1.prove_implies(
         b1._get_minimum_signed_by_knownbits() < threshold,
         working_min != threshold,
         z3.UGT(cl2set, set2cl),
-        z3.Not(b1.concrete_variable < new_threshold),
-    )
-    # precision: new_threshold is an element in the set, ie we
-    # couldn't have increased the bound further
-    b1.prove_implies(
-        b1._get_minimum_signed_by_knownbits() < threshold,
-        working_min != threshold,
-        z3.UGT(cl2set, set2cl),
-        z3_tnum_condition(new_threshold, b1.tvalue, b1.tmask),
+        z3.And(
+            # show that the new_threshold is larger than threshold
+            new_threshold > threshold,
+            # correctness: show that there are no elements x in b1 with
+            # threshold <= x < new_threshold
+            z3.Not(b1.concrete_variable < new_threshold),
+            # precision: new_threshold is an element in the set, ie we
+            # couldn't have increased the bound further
+            z3_tnum_condition(new_threshold, b1.tvalue, b1.tmask),
+        )
     )
 
 
@@ -1019,30 +1183,20 @@ def test_prove_shrink_bounds_by_knownbits_correctness_min_case2():
 
     new_threshold = b1._helper_min_case2(working_min, set2cl)
 
-    # check that the bound is not getting worse
     b1.prove_implies(
         b1._get_minimum_signed_by_knownbits() < threshold,
         working_min_ne_threshold,
         z3.ULE(cl2set, set2cl),
-        new_threshold > threshold
-    )
-
-    # correctness: show that there are no elements x in b1 with
-    # threshold <= x < new_threshold
-    b1.prove_implies(
-        b1._get_minimum_signed_by_knownbits() < threshold,
-        working_min_ne_threshold,
-        z3.ULE(cl2set, set2cl),
-        z3.Not(b1.concrete_variable < new_threshold),
-    )
-
-    # precision: new_threshold is an element in the set, ie we
-    # couldn't have increased the bound further
-    b1.prove_implies(
-        b1._get_minimum_signed_by_knownbits() < threshold,
-        working_min_ne_threshold,
-        z3.ULE(cl2set, set2cl),
-        z3_tnum_condition(new_threshold, b1.tvalue, b1.tmask),
+        z3.And(
+            # check that the bound is not getting worse
+            new_threshold > threshold,
+            # correctness: show that there are no elements x in b1 with
+            # threshold <= x < new_threshold
+            z3.Not(b1.concrete_variable < new_threshold),
+            # precision: new_threshold is an element in the set, ie we
+            # couldn't have increased the bound further
+            z3_tnum_condition(new_threshold, b1.tvalue, b1.tmask),
+        )
     )
 
 def test_prove_shrink_bounds_by_knownbits_max_case1():
@@ -1053,28 +1207,20 @@ def test_prove_shrink_bounds_by_knownbits_max_case1():
     working_min, cl2set, set2cl = b1._helper_min_max_prepare(threshold)
     new_threshold = b1._helper_max_case1(working_min, set2cl)
 
-    # show that the new_threshold is smaller than threshold
     b1.prove_implies(
         b1._get_maximum_signed_by_knownbits() > threshold,
         working_min != threshold,
         z3.ULT(cl2set, set2cl),
-        new_threshold < threshold,
-    )
-    # correctness: show that there are no elements x in b1 with
-    # new_threshold <= x < threshold
-    b1.prove_implies(
-        b1._get_maximum_signed_by_knownbits() > threshold,
-        working_min != threshold,
-        z3.ULT(cl2set, set2cl),
-        z3.Not(b1.concrete_variable > new_threshold),
-    )
-    # precision: new_threshold is an element in the set, ie we
-    # couldn't have increased the bound further
-    b1.prove_implies(
-        b1._get_maximum_signed_by_knownbits() > threshold,
-        working_min != threshold,
-        z3.ULT(cl2set, set2cl),
-        z3_tnum_condition(new_threshold, b1.tvalue, b1.tmask),
+        z3.And(
+            # show that the new_threshold is smaller than threshold
+            new_threshold < threshold,
+            # correctness: show that there are no elements x in b1 with
+            # new_threshold <= x < threshold
+            z3.Not(b1.concrete_variable > new_threshold),
+            # precision: new_threshold is an element in the set, ie we
+            # couldn't have increased the bound further
+            z3_tnum_condition(new_threshold, b1.tvalue, b1.tmask),
+        )
     )
 
 
@@ -1088,30 +1234,20 @@ def test_prove_shrink_bounds_by_knownbits_correctness_max_case2():
 
     new_threshold = b1._helper_max_case2(working_max, cl2set)
 
-    # check that the bound is not getting worse
     b1.prove_implies(
         b1._get_maximum_signed_by_knownbits() > threshold,
         working_max_ne_threshold,
         z3.UGE(cl2set, set2cl),
-        new_threshold < threshold
-    )
-
-    # correctness: show that there are no elements x in b1 with
-    # threshold <= x < new_threshold
-    b1.prove_implies(
-        b1._get_maximum_signed_by_knownbits() > threshold,
-        working_max_ne_threshold,
-        z3.UGE(cl2set, set2cl),
-        z3.Not(b1.concrete_variable > new_threshold),
-    )
-
-    # precision: new_threshold is an element in the set, ie we
-    # couldn't have increased the bound further
-    b1.prove_implies(
-        b1._get_maximum_signed_by_knownbits() > threshold,
-        working_max_ne_threshold,
-        z3.UGE(cl2set, set2cl),
-        z3_tnum_condition(new_threshold, b1.tvalue, b1.tmask),
+        z3.And(
+            # check that the bound is not getting worse
+            new_threshold < threshold,
+            # correctness: show that there are no elements x in b1 with
+            # threshold <= x < new_threshold
+            z3.Not(b1.concrete_variable > new_threshold),
+            # precision: new_threshold is an element in the set, ie we
+            # couldn't have increased the bound further
+            z3_tnum_condition(new_threshold, b1.tvalue, b1.tmask),
+        )
     )
 
 # ____________________________________________________________
@@ -1120,17 +1256,21 @@ def z3_lshift_overflow(a, b):
     res = a << b
     return res, (res >> b) == a
 
+def _z3_reduce_balanced(choose, args):
+    # reduce pairwise, so that the nesting depth of the Ifs is log2(len(args))
+    args = list(args)
+    while len(args) > 1:
+        res = [choose(args[i], args[i + 1]) for i in range(0, len(args) - 1, 2)]
+        if len(args) % 2:
+            res.append(args[-1])
+        args = res
+    return args[0]
+
 def z3_min(*args):
-    res = args[0]
-    for x in args[1:]:
-        res = z3.If(res < x, res, x)
-    return res
+    return _z3_reduce_balanced(lambda a, b: z3.If(a < b, a, b), args)
 
 def z3_max(*args):
-    res = args[0]
-    for x in args[1:]:
-        res = z3.If(res > x, res, x)
-    return res
+    return _z3_reduce_balanced(lambda a, b: z3.If(a > b, a, b), args)
 
 @z3_with_reduced_bitwidth(16)
 def test_prove_lshift_bound_logic():
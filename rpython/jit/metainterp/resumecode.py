@@ -31,23 +31,41 @@ NUMBERING = lltype.GcStruct('Numbering',
 NUMBERINGP.TO.become(NUMBERING)
 NULL_NUMBER = lltype.nullptr(NUMBERING)
 
-def append_numbering(lst, item):
+def _encode_sign(item):
     item = rffi.cast(lltype.Signed, item)
     item *= 2
     if item < 0:
         item = -1 - item
-
     assert item >= 0
+    return item
+_encode_sign._always_inline_ = True
+
+def numbering_item_size(item):
+    """ number of bytes that item takes up in the numbering """
+    item = _encode_sign(item)
     if item < 2**7:
-        lst.append(rffi.cast(rffi.UCHAR, item))
+        return 1
     elif item < 2**14:
-        lst.append(rffi.cast(rffi.UCHAR, item | 0x80))
-        lst.append(rffi.cast(rffi.UCHAR, item >> 7))
+        return 2
+    else:
+        return 3
+
+def write_numbering_item(code, index, item):
+    """ write item into the array code at index, return the index after it """
+    item = _encode_sign(item)
+    if item < 2**7:
+        code[index] = rffi.cast(rffi.UCHAR, item)
+        return index + 1
+    elif item < 2**14:
+        code[index] = rffi.cast(rffi.UCHAR, item | 0x80)
+        code[index + 1] = rffi.cast(rffi.UCHAR, item >> 7)
+        return index + 2
     else:
         assert item < 2**16
-        lst.append(rffi.cast(rffi.UCHAR, item | 0x80))
-        lst.append(rffi.cast(rffi.UCHAR, (item >> 7) | 0x80))
-        lst.append(rffi.cast(rffi.UCHAR, item >> 14))
+        code[index] = rffi.cast(rffi.UCHAR, item | 0x80)
+        code[index + 1] = rffi.cast(rffi.UCHAR, (item >> 7) | 0x80)
+        code[index + 2] = rffi.cast(rffi.UCHAR, item >> 14)
+        return index + 3
 
 
 def numb_next_item(numb, index):
@@ -73,7 +91,8 @@ def numb_next_n_items(numb, size, index):
     return index
 
 def unpack_numbering(numb):
-    l = []
+    # every item takes up at least one byte
+    l = objectmodel.newlist_hint(len(numb.code))
     i = 0
     while i < len(numb.code):
         next, i = numb_next_item(numb, i)
@@ -93,12 +112,15 @@ class Writer(object):
         return self.append_short(short)
 
     def create_numbering(self):
-        final = objectmodel.newlist_hint(len(self.current) * 3)
+        # compute the size first, to encode straight into the final array
+        size = 0
+        for item in self.current:
+            size += numbering_item_size(item)
+        numb = lltype.malloc(NUMBERING, size)
+        index = 0
         for item in self.current:
-            append_numbering(final, item)
-        numb = lltype.malloc(NUMBERING, len(final))
-        for i, elt in enumerate(final):
-            numb.code[i] = elt
+            index = write_numbering_item(numb.code, index, item)
+        assert index == size
         return numb
 
     def patch_current_size(self, index):
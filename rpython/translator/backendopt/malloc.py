@@ -1,12 +1,17 @@
+from collections import defaultdict
+
 from rpython.flowspace.model import Variable, Constant, SpaceOperation
-from rpython.tool.algo.unionfind import UnionFind
 from rpython.rtyper.lltypesystem import lltype
 from rpython.translator import simplify
 from rpython.translator.backendopt import removenoops
 from rpython.translator.backendopt.support import log
 
+# shared constant for the name of the field of the 'wrapper' GcStructs
+c_data = Constant('data', lltype.Void)
+
 
-class LifeTime:
+class LifeTime(object):
+    __slots__ = ('variables', 'creationpoints', 'usepoints')
 
     def __init__(self, (block, var)):
         assert isinstance(var, Variable)
@@ -25,15 +30,17 @@ class LifeTime:
 
 class BaseMallocRemover(object):
 
-    IDENTITY_OPS = ('same_as',)
-    SUBSTRUCT_OPS = ()
+    IDENTITY_OPS = frozenset(['same_as'])
+    SUBSTRUCT_OPS = frozenset()
     MALLOC_OP = None
-    FIELD_ACCESS = {}
-    SUBSTRUCT_ACCESS = {}
-    CHECK_ARRAY_INDEX = {}
+    FIELD_ACCESS = frozenset()
+    SUBSTRUCT_ACCESS = frozenset()
+    CHECK_ARRAY_INDEX = frozenset()
 
     def __init__(self, verbose=True):
         self.verbose = verbose
+        # {(STRUCT, frozenset(accessed_substructs)): result of flatten()}
+        self._flatten_cache = {}
 
     def check_malloc(self, op):
         return op.opname == self.MALLOC_OP
@@ -70,15 +77,14 @@ class BaseMallocRemover(object):
         # it by a flattened-out family of variables.  This family is given
         # by newvarsmap, whose keys are the 'flatnames'.
 
-        def list_newvars():
-            return [newvarsmap[key] for key in self.flatnames]
-
         assert block.operations != ()
         self.newops = []
         for op in block.operations:
-            for arg in op.args[1:]:   # should be the first arg only
-                assert arg not in vars
-            if op.args and op.args[0] in vars:
+            args = op.args
+            if args and args[0] in vars:
+                if __debug__:
+                    for arg in args[1:]:   # should be the first arg only
+                        assert arg not in vars
                 self.flowin_op(op, vars, newvarsmap)
             elif op.result in vars:
                 assert op.opname == self.MALLOC_OP
@@ -104,17 +110,22 @@ class BaseMallocRemover(object):
 
         assert block.exitswitch not in vars
 
+        newvars = None    # the final family of variables, built lazily
         for link in block.exits:
             appended = False
             newargs = []
             for arg in link.args:
                 if arg in vars:
                     if not appended:
-                        newargs += list_newvars()
+                        if newvars is None:
+                            newvars = [newvarsmap[key]
+                                       for key in self.flatnames]
+                        newargs += newvars
                         appended = True
                 else:
                     newargs.append(arg)
-            link.args[:] = newargs
+            if appended:
+                link.args[:] = newargs
 
         block.operations[:] = self.newops
 
@@ -125,19 +136,59 @@ class BaseMallocRemover(object):
         one to the other by following the links.  Each LifeTime also records all
         places where a Variable in the set is used (read) or build (created).
         """
-        lifetimes = UnionFind(LifeTime)
+        # A union-find over the (block, var) pairs.  Each pair is given a
+        # dense integer id the first time it is seen; the parent links,
+        # the weights and the LifeTime of each root are stored in lists
+        # indexed by these ids.  The LifeTime of a non-root is None.
+        ids = {}        # {block: {var: id}}
+        parents = []
+        weights = []
+        infos = []
+
+        def getblockids(block):
+            try:
+                return ids[block]
+            except KeyError:
+                blockids = ids[block] = {}
+                return blockids
+
+        def getid(blockids, block, var):
+            try:
+                return blockids[var]
+            except KeyError:
+                i = blockids[var] = len(parents)
+                parents.append(i)
+                weights.append(1)
+                infos.append(LifeTime((block, var)))
+                return i
+
+        def find(i):
+            # path halving
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        def getinfo(block, var):
+            return infos[find(getid(getblockids(block), block, var))]
 
         def set_creation_point(block, var, *cp):
-            _, _, info = lifetimes.find((block, var))
-            info.creationpoints.add(cp)
+            getinfo(block, var).creationpoints.add(cp)
 
         def set_use_point(block, var, *usepoint):
-            _, _, info = lifetimes.find((block, var))
-            info.usepoints.add(usepoint)
+            getinfo(block, var).usepoints.add(usepoint)
 
         def union(block1, var1, block2, var2):
             if isinstance(var1, Variable):
-                lifetimes.union((block1, var1), (block2, var2))
+                i1 = find(getid(getblockids(block1), block1, var1))
+                i2 = find(getid(getblockids(block2), block2, var2))
+                if i1 != i2:
+                    if weights[i1] < weights[i2]:
+                        i1, i2 = i2, i1
+                    infos[i1].absorb(infos[i2])
+                    infos[i2] = None
+                    parents[i2] = i1
+                    weights[i1] += weights[i2]
             elif isinstance(var1, Constant):
                 set_creation_point(block2, var2, "constant", var1)
             else:
@@ -149,70 +200,82 @@ class BaseMallocRemover(object):
         set_use_point(graph.exceptblock, graph.exceptblock.inputargs[0], "except")
         set_use_point(graph.exceptblock, graph.exceptblock.inputargs[1], "except")
 
-        for node in graph.iterblocks():
-                for op in node.operations:
-                    if op.opname in self.IDENTITY_OPS:
-                        # special-case these operations to identify their input
-                        # and output variables
-                        union(node, op.args[0], node, op.result)
+        # a single walk over the graph; the links are processed in a
+        # second loop over the same blocks, once all the creation points
+        # coming from operations are known
+        IDENTITY_OPS = self.IDENTITY_OPS
+        SUBSTRUCT_OPS = self.SUBSTRUCT_OPS
+        blocks = list(graph.iterblocks())
+        for block in blocks:
+            blockids = getblockids(block)
+            for op in block.operations:
+                opname = op.opname
+                if opname in IDENTITY_OPS:
+                    # special-case these operations to identify their input
+                    # and output variables
+                    union(block, op.args[0], block, op.result)
+                    continue
+                if opname in SUBSTRUCT_OPS:
+                    if self.visit_substruct_op(block, union, op):
                         continue
-                    if op.opname in self.SUBSTRUCT_OPS:
-                        if self.visit_substruct_op(node, union, op):
-                            continue
-                    for i in range(len(op.args)):
-                        if isinstance(op.args[i], Variable):
-                            set_use_point(node, op.args[i], "op", node, op, i)
-                    set_creation_point(node, op.result, "op", node, op)
-                if isinstance(node.exitswitch, Variable):
-                    set_use_point(node, node.exitswitch, "exitswitch", node)
-
-        for node in graph.iterlinks():
-            if isinstance(node.last_exception, Variable):
-                set_creation_point(node.prevblock, node.last_exception,
-                                   "last_exception")
-            if isinstance(node.last_exc_value, Variable):
-                set_creation_point(node.prevblock, node.last_exc_value,
-                                   "last_exc_value")
-            duplicate_info = set()
-            for i, arg in enumerate(node.args):
-                union(node.prevblock, arg,
-                      node.target, node.target.inputargs[i])
-                if isinstance(arg, Variable):
-
-                    _, _, info = lifetimes.find((node.prevblock, arg))
-                    if info in duplicate_info and len(info.creationpoints) > 1:
-                        # same variable (up to renaming via same_as or
-                        # cast_pointer) present several times in link.args, and
-                        # the variable is created in two different places:
-                        # consider it as a 'use' of the variable, which will
-                        # disable malloc optimization (aliasing problems)
-                        set_use_point(node.prevblock, arg, "dup", node, i)
-                    else:
-                        duplicate_info.add(info)
-
-        return lifetimes.infos()
+                for i, arg in enumerate(op.args):
+                    if isinstance(arg, Variable):
+                        info = infos[find(getid(blockids, block, arg))]
+                        info.usepoints.add(("op", block, op, i))
+                info = infos[find(getid(blockids, block, op.result))]
+                info.creationpoints.add(("op", block, op))
+            if isinstance(block.exitswitch, Variable):
+                set_use_point(block, block.exitswitch, "exitswitch", block)
+
+        for block in blocks:
+            for link in block.exits:
+                if isinstance(link.last_exception, Variable):
+                    set_creation_point(block, link.last_exception,
+                                       "last_exception")
+                if isinstance(link.last_exc_value, Variable):
+                    set_creation_point(block, link.last_exc_value,
+                                       "last_exc_value")
+                duplicate_info = set()
+                target = link.target
+                for i, arg in enumerate(link.args):
+                    union(block, arg, target, target.inputargs[i])
+                    if isinstance(arg, Variable):
+                        info = getinfo(block, arg)
+                        if (info in duplicate_info and
+                                len(info.creationpoints) > 1):
+                            # same variable (up to renaming via same_as or
+                            # cast_pointer) present several times in
+                            # link.args, and the variable is created in two
+                            # different places: consider it as a 'use' of
+                            # the variable, which will disable malloc
+                            # optimization (aliasing problems)
+                            set_use_point(block, arg, "dup", link, i)
+                        else:
+                            duplicate_info.add(info)
+
+        return [info for info in infos if info is not None]
 
     def _try_inline_malloc(self, info):
         """Try to inline the mallocs creation and manipulation of the Variables
         in the given LifeTime."""
-        # the values must be only ever created by a "malloc"
-        lltypes = set()
+        # the values must be only ever created by a "malloc", and
+        # there must be a single largest malloced GcStruct;
+        # all variables can point to it or to initial substructures
+        concretetype = None
         for cp in info.creationpoints:
             if cp[0] != "op":
                 return False
             op = cp[2]
             if not self.check_malloc(op):
                 return False
+            if concretetype is None:
+                concretetype = op.result.concretetype
+            elif op.result.concretetype != concretetype:
+                return False
             if not self.inline_type(op.args[0].value):
                 return False
-
-            lltypes.add(op.result.concretetype)
-
-        # there must be a single largest malloced GcStruct;
-        # all variables can point to it or to initial substructures
-        if len(lltypes) != 1:
+        if concretetype is None:
             return False
-        concretetype, = lltypes
         STRUCT = self.get_STRUCT(concretetype)
 
         # must be only ever accessed via getfield/setfield/getsubstruct/
@@ -257,49 +320,60 @@ class BaseMallocRemover(object):
         # variable which is a pointer to a GcStruct-wrapper; each is malloc'ed
         # individually, in an exploded way.  (The next malloc removal pass will
         # get rid of them again, in the typical case.)
-        self.flatnames = []
-        self.flatconstants = {}
-        self.needsubmallocs = []
-        self.newvarstype = {}       # map {item-of-flatnames: concretetype}
-        self.direct_fieldptr_key = {}
-        self.flatten(STRUCT)
-        assert len(self.direct_fieldptr_key) <= 1
-
-        variables_by_block = {}
+        #
+        # The result only depends on STRUCT and on accessed_substructs, and
+        # is not modified afterwards, so it is cached across the iterations
+        # of remove_simple_mallocs().
+        cachekey = STRUCT, frozenset(self.accessed_substructs)
+        try:
+            (self.flatnames, self.flatconstants, self.needsubmallocs,
+             self.newvarstype, self.direct_fieldptr_key) = (
+                self._flatten_cache[cachekey])
+        except KeyError:
+            self.flatnames = []
+            self.flatconstants = {}
+            self.needsubmallocs = []
+            self.newvarstype = {}   # map {item-of-flatnames: concretetype}
+            self.direct_fieldptr_key = {}
+            self.flatten(STRUCT)
+            assert len(self.direct_fieldptr_key) <= 1
+            self._flatten_cache[cachekey] = (
+                self.flatnames, self.flatconstants, self.needsubmallocs,
+                self.newvarstype, self.direct_fieldptr_key)
+
+        variables_by_block = defaultdict(set)
         for block, var in info.variables:
-            vars = variables_by_block.setdefault(block, set())
-            vars.add(var)
+            variables_by_block[block].add(var)
+
+        # all the creation points have been checked above to be mallocs
+        mallocs_by_block = {}
+        for _, block, op in info.creationpoints:
+            mallocs_by_block.setdefault(block, []).append(op.result)
 
         count = [0]
 
         for block, vars in variables_by_block.items():
 
             # look for variables arriving from outside the block
-            newvarsmap = None
-            newinputargs = []
-            inputvars = set()
-            for var in block.inputargs:
-                if var in vars:
-                    inputvars.add(var)
-                    if newvarsmap is None:
-                        newvarsmap = {}
+            inputvars = {var for var in block.inputargs if var in vars}
+            if inputvars:
+                newvarsmap = {}
+                newinputargs = []
+                for var in block.inputargs:
+                    if var not in inputvars:
+                        newinputargs.append(var)
+                    elif not newvarsmap:
+                        # the whole family replaces the first input var
                         for key in self.flatnames:
                             newvar = Variable()
                             newvar.concretetype = self.newvarstype[key]
                             newvarsmap[key] = newvar
                             newinputargs.append(newvar)
-                else:
-                    newinputargs.append(var)
-            block.inputargs[:] = newinputargs
-            if inputvars:
+                block.inputargs[:] = newinputargs
                 self.flowin(block, count, inputvars, newvarsmap)
 
-            # look for variables created inside the block by a malloc
-            vars_created_here = []
-            for op in block.operations:
-                if self.check_malloc(op) and op.result in vars:
-                    vars_created_here.append(op.result)
-            for var in vars_created_here:
+            # variables created inside the block by a malloc
+            for var in mallocs_by_block.get(block, ()):
                 self.flowin(block, count, {var}, newvarsmap=None)
 
         return count[0]
@@ -332,21 +406,39 @@ class BaseMallocRemover(object):
 
 class LLTypeMallocRemover(BaseMallocRemover):
 
-    IDENTITY_OPS = ("same_as", "cast_pointer")
-    SUBSTRUCT_OPS = ("getsubstruct", "direct_fieldptr")
+    IDENTITY_OPS = frozenset(["same_as", "cast_pointer"])
+    SUBSTRUCT_OPS = frozenset(["getsubstruct", "direct_fieldptr"])
     MALLOC_OP = "malloc"
-    FIELD_ACCESS =     dict.fromkeys(["getfield",
-                                      "setfield",
-                                      "ptr_iszero",
-                                      "ptr_nonzero",
-                                      "getarrayitem",
-                                      "setarrayitem"])
-    SUBSTRUCT_ACCESS = dict.fromkeys(["getsubstruct",
-                                      "direct_fieldptr",
-                                      "getarraysubstruct"])
-    CHECK_ARRAY_INDEX = dict.fromkeys(["getarrayitem",
-                                       "setarrayitem",
-                                       "getarraysubstruct"])
+    FIELD_ACCESS =      frozenset(["getfield",
+                                   "setfield",
+                                   "ptr_iszero",
+                                   "ptr_nonzero",
+                                   "getarrayitem",
+                                   "setarrayitem"])
+    SUBSTRUCT_ACCESS =  frozenset(["getsubstruct",
+                                   "direct_fieldptr",
+                                   "getarraysubstruct"])
+    CHECK_ARRAY_INDEX = frozenset(["getarrayitem",
+                                   "setarrayitem",
+                                   "getarraysubstruct"])
+
+    def __init__(self, verbose=True):
+        BaseMallocRemover.__init__(self, verbose)
+        self._equivalent_substruct_cache = {}
+        self._default_constants = {}    # {FIELDTYPE: Constant(default)}
+        self._flowin_handlers = {
+            "getfield":          self._flowin_getfield,
+            "getarrayitem":      self._flowin_getfield,
+            "setfield":          self._flowin_setfield,
+            "setarrayitem":      self._flowin_setfield,
+            "same_as":           self._flowin_same_as,
+            "cast_pointer":      self._flowin_same_as,
+            "getsubstruct":      self._flowin_substruct,
+            "getarraysubstruct": self._flowin_substruct,
+            "direct_fieldptr":   self._flowin_substruct,
+            "ptr_iszero":        self._flowin_ptr_zero,
+            "ptr_nonzero":       self._flowin_ptr_zero,
+        }
 
     def check_malloc(self, op):
         if op.opname == 'malloc':
@@ -385,6 +477,15 @@ class LLTypeMallocRemover(BaseMallocRemover):
         return True
 
     def equivalent_substruct(self, S, fieldname):
+        key = S, fieldname
+        try:
+            return self._equivalent_substruct_cache[key]
+        except KeyError:
+            result = self._equivalent_substruct(S, fieldname)
+            self._equivalent_substruct_cache[key] = result
+            return result
+
+    def _equivalent_substruct(self, S, fieldname):
         # we consider a pointer to a GcStruct S as equivalent to a
         # pointer to a substructure 'S.fieldname' if it's the first
         # inlined sub-GcStruct.  As an extension we also allow a pointer
@@ -443,15 +544,21 @@ class LLTypeMallocRemover(BaseMallocRemover):
                 self.newvarstype[key] = lltype.Ptr(lltype.GcStruct('wrapper',
                                                           ('data', FIELDTYPE)))
             elif not isinstance(FIELDTYPE, lltype.ContainerType):
-                example = FIELDTYPE._defl()
-                constant = Constant(example)
-                constant.concretetype = FIELDTYPE
-                self.flatconstants[key] = constant
+                self.flatconstants[key] = self.default_constant(FIELDTYPE)
                 self.flatnames.append(key)
                 self.newvarstype[key] = FIELDTYPE
             #else:
             #   the inlined substructure is never accessed, drop it
 
+    def default_constant(self, FIELDTYPE):
+        try:
+            return self._default_constants[FIELDTYPE]
+        except KeyError:
+            constant = Constant(FIELDTYPE._defl())
+            constant.concretetype = FIELDTYPE
+            self._default_constants[FIELDTYPE] = constant
+            return constant
+
     def key_for_field_access(self, S, fldname):
         if isinstance(S, lltype.FixedSizeArray):
             if not isinstance(fldname, str):      # access by index
@@ -470,79 +577,90 @@ class LLTypeMallocRemover(BaseMallocRemover):
         return SpaceOperation("debug_fatalerror", [c_msg], v_result)
 
     def flowin_op(self, op, vars, newvarsmap):
-        if op.opname in ("getfield", "getarrayitem"):
-            S = op.args[0].concretetype.TO
-            fldname = op.args[1].value
-            key = self.key_for_field_access(S, fldname)
-            if key not in newvarsmap:
-                newop = self.handle_unreachable(op.result)
-            elif key in self.accessed_substructs:
-                c_name = Constant('data', lltype.Void)
-                newop = SpaceOperation("getfield",
-                                       [newvarsmap[key], c_name],
-                                       op.result)
-            else:
-                newop = SpaceOperation("same_as",
-                                       [newvarsmap[key]],
+        try:
+            handler = self._flowin_handlers[op.opname]
+        except KeyError:
+            raise AssertionError(op.opname)
+        handler(op, vars, newvarsmap)
+
+    def _flowin_getfield(self, op, vars, newvarsmap):
+        # "getfield" or "getarrayitem"
+        args = op.args
+        S = args[0].concretetype.TO
+        fldname = args[1].value
+        key = self.key_for_field_access(S, fldname)
+        if key not in newvarsmap:
+            newop = self.handle_unreachable(op.result)
+        elif key in self.accessed_substructs:
+            newop = SpaceOperation("getfield",
+                                   [newvarsmap[key], c_data],
+                                   op.result)
+        else:
+            newop = SpaceOperation("same_as",
+                                   [newvarsmap[key]],
+                                   op.result)
+        self.newops.append(newop)
+
+    def _flowin_setfield(self, op, vars, newvarsmap):
+        # "setfield" or "setarrayitem"
+        args = op.args
+        S = args[0].concretetype.TO
+        fldname = args[1].value
+        key = self.key_for_field_access(S, fldname)
+        if key not in newvarsmap:
+            newop = self.handle_unreachable(op.result)
+            self.newops.append(newop)
+        elif key in self.accessed_substructs:
+            newop = SpaceOperation("setfield",
+                             [newvarsmap[key], c_data, args[2]],
                                        op.result)
             self.newops.append(newop)
-        elif op.opname in ("setfield", "setarrayitem"):
-            S = op.args[0].concretetype.TO
-            fldname = op.args[1].value
-            key = self.key_for_field_access(S, fldname)
-            if key not in newvarsmap:
-                newop = self.handle_unreachable(op.result)
-                self.newops.append(newop)
-            elif key in self.accessed_substructs:
-                c_name = Constant('data', lltype.Void)
-                newop = SpaceOperation("setfield",
-                                 [newvarsmap[key], c_name, op.args[2]],
-                                           op.result)
-                self.newops.append(newop)
-            else:
-                newvarsmap[key] = op.args[2]
-        elif op.opname in ("same_as", "cast_pointer"):
+        else:
+            newvarsmap[key] = args[2]
+
+    def _flowin_same_as(self, op, vars, newvarsmap):
+        # "same_as" or "cast_pointer"
+        vars.add(op.result)
+        # Consider the two pointers (input and result) as
+        # equivalent.  We can, and indeed must, use the same
+        # flattened list of variables for both, as a "setfield"
+        # via one pointer must be reflected in the other.
+
+    def _flowin_substruct(self, op, vars, newvarsmap):
+        # "getsubstruct", "getarraysubstruct" or "direct_fieldptr"
+        args = op.args
+        S = args[0].concretetype.TO
+        fldname = args[1].value
+        opname = op.opname
+        if opname == "getarraysubstruct":
+            fldname = 'item%d' % fldname
+        equiv = self.equivalent_substruct(S, fldname)
+        if equiv:
+            # exactly like a cast_pointer
+            assert op.result not in vars
             vars.add(op.result)
-            # Consider the two pointers (input and result) as
-            # equivalent.  We can, and indeed must, use the same
-            # flattened list of variables for both, as a "setfield"
-            # via one pointer must be reflected in the other.
-        elif op.opname in ("getsubstruct", "getarraysubstruct",
-                           "direct_fieldptr"):
-            S = op.args[0].concretetype.TO
-            fldname = op.args[1].value
-            if op.opname == "getarraysubstruct":
-                fldname = 'item%d' % fldname
-            equiv = self.equivalent_substruct(S, fldname)
-            if equiv:
-                # exactly like a cast_pointer
-                assert op.result not in vars
-                vars.add(op.result)
+        else:
+            # do it with a getsubstruct on the independently
+            # malloc'ed GcStruct
+            if opname != "direct_fieldptr":
+                opname = "getsubstruct"
+            try:
+                v = newvarsmap[S, fldname]
+            except KeyError:
+                newop = self.handle_unreachable(op.result)
             else:
-                # do it with a getsubstruct on the independently
-                # malloc'ed GcStruct
-                if op.opname == "direct_fieldptr":
-                    opname = "direct_fieldptr"
-                else:
-                    opname = "getsubstruct"
-                try:
-                    v = newvarsmap[S, fldname]
-                except KeyError:
-                    newop = self.handle_unreachable(op.result)
-                else:
-                    cname = Constant('data', lltype.Void)
-                    newop = SpaceOperation(opname,
-                                           [v, cname],
-                                           op.result)
-                self.newops.append(newop)
-        elif op.opname in ("ptr_iszero", "ptr_nonzero"):
-            # we know the pointer is not NULL if it comes from
-            # a successful malloc
-            c = Constant(op.opname == "ptr_nonzero", lltype.Bool)
-            newop = SpaceOperation('same_as', [c], op.result)
+                newop = SpaceOperation(opname,
+                                       [v, c_data],
+                                       op.result)
             self.newops.append(newop)
-        else:
-            raise AssertionError(op.opname)
+
+    def _flowin_ptr_zero(self, op, vars, newvarsmap):
+        # "ptr_iszero" or "ptr_nonzero":
+        # we know the pointer is not NULL if it comes from
+        # a successful malloc
+        c = Constant(op.opname == "ptr_nonzero", lltype.Bool)
+        newop = SpaceOperation('same_as', [c], op.result)
+        self.newops.append(newop)
 
 
 def remove_simple_mallocs(graph, verbose=True):